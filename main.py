@@ -1,16 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
 import os
 
 from random_composition_generator import (
     load_library,
     build_composition_and_bundle,
+    generate_many,
     normalize_patient_refs_in_bundle,
-    structural_validate_bundle
+    structural_validate_bundle,
+    read_json_file,
+    write_json_file
 )
 
+def print_issues(issues):
+    if issues:
+        print("⚠ Structural validation issues found:")
+        for it in issues:
+            if isinstance(it, dict):
+                sev = it.get("severity", "")
+                det = it.get("detail", str(it))
+                print(f" - [{sev}] {det}")
+            else:
+                print(" -", it)
+    else:
+        print("✔ No structural issues found by validator.")
+
 def main():
 
     parser = argparse.ArgumentParser(description="Generate randomized FHIR Composition bundles.")
@@ -24,6 +39,10 @@ def main():
                         help="Optional JSON file with mapping old_ref -> new_ref to apply to bundle before saving.")
     parser.add_argument("--randomize-values", action="store_true", default=False,
                         help="If set, synthesize randomized vital signs and basic lab observations and include them in the bundle.")
+    parser.add_argument("--pretty", action="store_true", default=False,
+                        help="If set, write indented JSON instead of compact output.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes; values above 1 generate bundles in parallel.")
 
     args = parser.parse_args()
 
@@ -35,49 +54,54 @@ def main():
 
     print(f"Loaded {len(resources_by_key)} resources from input_data.")
 
+    mapping = None
+    if args.map_file and os.path.exists(args.map_file):
+        mapping = read_json_file(args.map_file)
+
+    if args.workers > 1:
+        results = generate_many(
+            count,
+            folder="input_data",
+            workers=args.workers,
+            use_synthetic=args.use_synthetic,
+            randomize_values=args.randomize_values,
+            pretty=args.pretty,
+            mapping=mapping,
+            canonical=args.canonical_patient
+        )
+        for i, (composition_id, output_file, issues) in enumerate(results):
+            print(f"\n=== Bundle {i+1}/{count} ===")
+            print_issues(issues)
+            print(f"Saved → {output_file}")
+            print(f"Composition ID → {composition_id}")
+        return
+
     for i in range(count):
         print(f"\n=== Generating bundle {i+1}/{count} ===")
-        # generator returns (composition, bundle, output_file)
+        # generator returns (composition, bundle, output_file); the bundle is written once below
         composition, bundle, output_file = build_composition_and_bundle(
             resources_by_key,
             index_by_type,
             compositions_list,
             use_synthetic=args.use_synthetic,
-            randomize_values=args.randomize_values
+            randomize_values=args.randomize_values,
+            write=False
         )
 
         # apply mapping if requested
-        if args.map_file and os.path.exists(args.map_file):
-            with open(args.map_file, "r", encoding="utf-8") as fh:
-                mapping = json.load(fh)
+        if mapping:
             normalize_patient_refs_in_bundle(bundle, mapping=mapping)
-            # overwrite output file with mapped bundle
-            with open(output_file, "w", encoding="utf-8") as fh:
-                json.dump(bundle, fh, indent=2, ensure_ascii=False)
 
         if args.canonical_patient:
             normalize_patient_refs_in_bundle(bundle, canonical=args.canonical_patient)
-            with open(output_file, "w", encoding="utf-8") as fh:
-                json.dump(bundle, fh, indent=2, ensure_ascii=False)
 
         # Run structural validation to detect issues
         issues = structural_validate_bundle(bundle)
-        if issues:
-            print("⚠ Structural validation issues found:")
-            for it in issues:
-                if isinstance(it, dict):
-                    sev = it.get("severity", "")
-                    det = it.get("detail", str(it))
-                    print(f" - [{sev}] {det}")
-                else:
-                    print(" -", it)
-        else:
-            print("✔ No structural issues found by validator.")
-
-        # Ensure bundle saved (in case mapping/validation changed it)
+        print_issues(issues)
+
+        # Save once, after mapping and validation
         os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
-        with open(output_file, "w", encoding="utf-8") as fh:
-            json.dump(bundle, fh, indent=2, ensure_ascii=False)
+        write_json_file(bundle, output_file, pretty=args.pretty)
 
         print(f"Saved → {output_file}")
         print(f"Composition ID → {composition.get('id')}")
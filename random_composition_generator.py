@@ -13,13 +13,25 @@ import json
 import os
 import random
 import re
-import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:  # fall back to ujson, then stdlib json
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 # Config
 LIB_FOLDER = "input_data"
 INPUT_PREFIX = "composition_"
 OUTPUT_FOLDER = "output"
+IO_BUFFER_SIZE = 1 << 16
+STREAM_ENTRY_THRESHOLD = 1000
+LOAD_WORKERS = min(8, os.cpu_count() or 1)
 
 # ---- Section & Entry Limits (Option A) ----
 MIN_SECTIONS = 1
@@ -28,15 +40,86 @@ MIN_ENTRIES_PER_SECTION = 1
 MAX_ENTRIES_PER_SECTION = 10
 
 REF_RE = re.compile(r"([A-Za-z]+)\/([A-Za-z0-9\-\._]+)$")
-
-def get_output_filename():
-    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+# id half of REF_RE over serialized JSON; the closing quote plays the role of "$".
+# Kept on stdlib re: the pattern starts with a literal and never backtracks, and on
+# per-resource blobs re2's call overhead made it ~5x slower than re.
+REF_ID_RE_BYTES = re.compile(rb'/([A-Za-z0-9._-]+)"')
+_TYPE_BYTES = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+
+def _new_id():
+    # 32 random hex chars; as collision-resistant as a uuid4 without building a UUID object
+    return os.urandom(16).hex()
+
+def get_output_filename(now=None, suffix=None):
+    timestamp = (now or datetime.utcnow()).strftime("%Y%m%dT%H%M%SZ")
+    if suffix is not None:
+        return f"{OUTPUT_FOLDER}/bundle_{timestamp}_{suffix}.json"
     return f"{OUTPUT_FOLDER}/bundle_{timestamp}.json"
 
 
+# -------------------------
+# JSON read/write helpers
+# -------------------------
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(obj, pretty=False):
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(obj, option=option)
+elif ujson is not None:
+    _loads = ujson.loads
+
+    def _dumps(obj, pretty=False):
+        # ujson escapes "/" by default, which would also hide references from the scanner
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False,
+                           indent=2 if pretty else 0).encode("utf-8")
+else:
+    _loads = json.loads
+
+    def _dumps(obj, pretty=False):
+        if pretty:
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def read_json_file(path):
+    with open(path, "rb", buffering=IO_BUFFER_SIZE) as fh:
+        return _loads(fh.read())
+
+def write_json_file(obj, path, pretty=False):
+    # compact unless asked; small documents are serialized fully and written once
+    entries = obj.get("entry") if isinstance(obj, dict) else None
+    if pretty or not isinstance(entries, list) or len(entries) <= STREAM_ENTRY_THRESHOLD:
+        data = _dumps(obj, pretty)
+        with open(path, "wb", buffering=IO_BUFFER_SIZE) as fh:
+            fh.write(data)
+        return
+
+    # large bundles: frame the envelope by hand and serialize one entry at a time, so the
+    # whole document never has to exist as a single bytes object
+    head = _dumps({k: v for k, v in obj.items() if k != "entry"})
+    with open(path, "wb", buffering=IO_BUFFER_SIZE) as fh:
+        fh.write(head[:-1])
+        fh.write(b',"entry":[' if len(head) > 2 else b'"entry":[')
+        for i, entry in enumerate(entries):
+            if i:
+                fh.write(b",")
+            fh.write(_dumps(entry))
+        fh.write(b"]}")
+
+
 # -------------------------
 # Library loading utilities
 # -------------------------
+def _index_resource(resource, resources_by_key, index_by_type, compositions_list):
+    rtype = resource["resourceType"]
+    rid = resource.get("id") or _new_id()
+    resource["id"] = rid
+    key = f"{rtype}/{rid}"
+    resources_by_key[key] = resource
+    index_by_type.setdefault(rtype, []).append(key)
+    if rtype == "Composition":
+        compositions_list.append(resource)
+
 def load_library(folder, prefix=INPUT_PREFIX):
     resources_by_key = {}
     index_by_type = {}
@@ -45,40 +128,38 @@ def load_library(folder, prefix=INPUT_PREFIX):
     if not os.path.exists(folder):
         return resources_by_key, index_by_type, compositions_list
 
-    files = [f for f in os.listdir(folder) if f.startswith(prefix) and f.endswith(".json")]
-    for fname in files:
-        path = os.path.join(folder, fname)
-        with open(path, "r", encoding="utf-8") as fh:
-            try:
-                data = json.load(fh)
-            except Exception as e:
-                print(f"Warning: cannot parse {fname}: {e}")
-                continue
+    with os.scandir(folder) as it:
+        files = [(e.name, e.path) for e in it
+                 if e.name.startswith(prefix) and e.name.endswith(".json") and e.is_file()]
+    def _read(path):
+        try:
+            return read_json_file(path), None
+        except Exception as e:
+            return None, e
+
+    # reads/parses are independent per file; indexing below stays single-threaded and in file order
+    paths = [path for _, path in files]
+    workers = min(LOAD_WORKERS, len(paths))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            parsed = list(ex.map(_read, paths))
+    else:
+        parsed = list(map(_read, paths))
+
+    for (fname, _), (data, err) in zip(files, parsed):
+        if err is not None:
+            print(f"Warning: cannot parse {fname}: {err}")
+            continue
 
         if isinstance(data, dict) and data.get("resourceType") == "Bundle" and "entry" in data:
-            for entry in data.get("entry", []):
+            for entry in data["entry"]:
                 resource = entry.get("resource")
                 if not resource or "resourceType" not in resource:
                     continue
-                rtype = resource["resourceType"]
-                rid = resource.get("id") or str(uuid.uuid4())
-                resource["id"] = rid
-                key = (rtype, rid)
-                resources_by_key[key] = resource
-                index_by_type.setdefault(rtype, []).append(key)
-                if rtype == "Composition":
-                    compositions_list.append(resource)
+                _index_resource(resource, resources_by_key, index_by_type, compositions_list)
 
         elif isinstance(data, dict) and "resourceType" in data:
-            resource = data
-            rtype = resource["resourceType"]
-            rid = resource.get("id") or str(uuid.uuid4())
-            resource["id"] = rid
-            key = (rtype, rid)
-            resources_by_key[key] = resource
-            index_by_type.setdefault(rtype, []).append(key)
-            if rtype == "Composition":
-                compositions_list.append(resource)
+            _index_resource(data, resources_by_key, index_by_type, compositions_list)
 
         else:
             print(f"Unrecognized structure in {fname}")
@@ -90,7 +171,7 @@ def load_library(folder, prefix=INPUT_PREFIX):
 # Synthetic Patient helper
 # -------------------------
 def generate_synthetic_patient():
-    pid = "P"+str(uuid.uuid4())
+    pid = "P"+_new_id()
     return {
         "resourceType": "Patient",
         "id": pid,
@@ -121,75 +202,88 @@ def _random_range(mean, std, clamp_min=None, clamp_max=None):
         return int(round(val))
     return round(val, 1)
 
+def _loinc_code(code, display, text):
+    return {"coding":[{"system":"http://loinc.org","code":code,"display":display}],"text":text}
+
+def _ucum_quantity(unit, code):
+    return {"unit":unit, "system":"http://unitsofmeasure.org", "code":code}
+
+# Observation skeletons: (category/code fields, valueQuantity minus value, _random_range args).
+# They are shared by every generated Observation and must be treated as read-only; only the
+# per-call leaves (id, subject, effectiveDateTime, values) are built fresh.
+_VITAL_SIGNS_CATEGORY = [{"coding":[{"system":"http://terminology.hl7.org/CodeSystem/observation-category","code":"vital-signs"}]}]
+
+_HEART_RATE = (
+    {"category":[{"coding":[{"system":"http://terminology.hl7.org/CodeSystem/observation-category","code":"vital-signs","display":"Vital Signs"}]}],
+     "code":_loinc_code("8867-4", "Heart rate", "Heart rate")},
+    _ucum_quantity("beats/minute", "{beats}/min"), (72, 8, 40, 180))
+_RESPIRATORY_RATE = (
+    {"category":_VITAL_SIGNS_CATEGORY, "code":_loinc_code("9279-1", "Respiratory rate", "Respiratory rate")},
+    _ucum_quantity("breaths/min", "breaths/min"), (16, 3, 6, 40))
+_BLOOD_PRESSURE_PANEL = {"category":_VITAL_SIGNS_CATEGORY, "code":_loinc_code("85354-9", "Blood pressure panel", "Blood pressure")}
+_BLOOD_PRESSURE_COMPONENTS = [
+    (_loinc_code("8480-6", "Systolic blood pressure", "Systolic BP"), _ucum_quantity("mmHg", "mm[Hg]"), (120, 12, 70, 240)),
+    (_loinc_code("8462-4", "Diastolic blood pressure", "Diastolic BP"), _ucum_quantity("mmHg", "mm[Hg]"), (78, 8, 40, 140)),
+]
+_BODY_TEMPERATURE = (
+    {"category":_VITAL_SIGNS_CATEGORY, "code":_loinc_code("8310-5", "Body temperature", "Body temperature")},
+    _ucum_quantity("Cel", "Cel"), (36.6, 0.4, 34.0, 42.0))
+_OXYGEN_SATURATION = (
+    {"category":_VITAL_SIGNS_CATEGORY, "code":_loinc_code("2708-6", "Oxygen saturation in Arterial blood by Pulse oximetry", "SpO2")},
+    _ucum_quantity("%", "%"), (98, 1.5, 80, 100))
+
+_BASIC_LABS = [
+    # Hemoglobin g/dL
+    ({"code":_loinc_code("718-7", "Hemoglobin [Mass/volume] in Blood", "Hemoglobin")},
+     _ucum_quantity("g/dL", "g/dL"), (13.5, 1.2, 6, 20)),
+    # WBC x10^9/L
+    ({"code":_loinc_code("6690-2", "Leukocytes [#/volume] in Blood by Automated count", "WBC")},
+     _ucum_quantity("10^9/L", "10*9/L"), (7.0, 2.5, 1.0, 30.0)),
+    # Platelets x10^9/L
+    ({"code":_loinc_code("777-3", "Platelets [#/volume] in Blood by Automated count", "Platelets")},
+     _ucum_quantity("10^9/L", "10*9/L"), (250, 60, 50, 700)),
+    # Sodium mmol/L
+    ({"code":_loinc_code("2951-2", "Sodium [Moles/volume] in Serum or Plasma", "Sodium")},
+     _ucum_quantity("mmol/L", "mmol/L"), (140, 3, 120, 160)),
+    # Potassium mmol/L
+    ({"code":_loinc_code("2823-3", "Potassium [Moles/volume] in Serum or Plasma", "Potassium")},
+     _ucum_quantity("mmol/L", "mmol/L"), (4.1, 0.4, 2.5, 7.0)),
+    # Creatinine mg/dL
+    ({"code":_loinc_code("2160-0", "Creatinine [Mass/volume] in Serum or Plasma", "Creatinine")},
+     _ucum_quantity("mg/dL", "mg/dL"), (0.95, 0.25, 0.2, 10.0)),
+    # Glucose mg/dL
+    ({"code":_loinc_code("2345-7", "Glucose [Mass/volume] in Blood", "Glucose")},
+     _ucum_quantity("mg/dL", "mg/dL"), (98, 20, 40, 400)),
+]
+
+def _new_observation(fields, synthetic_patient_ref, ts):
+    obs = {"resourceType":"Observation", "id": _new_id(), "status":"final"}
+    obs.update(fields)
+    obs["subject"] = {"reference": synthetic_patient_ref}
+    obs["effectiveDateTime"] = ts
+    return obs
+
+def _quantity_observation(template, synthetic_patient_ref, ts):
+    fields, quantity, value_range = template
+    obs = _new_observation(fields, synthetic_patient_ref, ts)
+    obs["valueQuantity"] = {"value": _random_range(*value_range), **quantity}
+    return obs
+
 def generate_vitals_observations(synthetic_patient_ref, encounter_ref=None, timestamp=None):
     ts = timestamp or datetime.utcnow().isoformat() + "Z"
-    obs = []
-    # Heart rate
-    hr = _random_range(72, 8, 40, 180)
-    obs.append({
-        "resourceType":"Observation",
-        "id": str(uuid.uuid4()),
-        "status":"final",
-        "category":[{"coding":[{"system":"http://terminology.hl7.org/CodeSystem/observation-category","code":"vital-signs","display":"Vital Signs"}]}],
-        "code":{"coding":[{"system":"http://loinc.org","code":"8867-4","display":"Heart rate"}],"text":"Heart rate"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": hr, "unit":"beats/minute", "system":"http://unitsofmeasure.org", "code":"{beats}/min"}
-    })
-    # Respiratory rate
-    rr = _random_range(16, 3, 6, 40)
-    obs.append({
-        "resourceType":"Observation",
-        "id": str(uuid.uuid4()),
-        "status":"final",
-        "category":[{"coding":[{"system":"http://terminology.hl7.org/CodeSystem/observation-category","code":"vital-signs"}]}],
-        "code":{"coding":[{"system":"http://loinc.org","code":"9279-1","display":"Respiratory rate"}],"text":"Respiratory rate"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": rr, "unit":"breaths/min", "system":"http://unitsofmeasure.org", "code":"breaths/min"}
-    })
+    obs = [
+        _quantity_observation(_HEART_RATE, synthetic_patient_ref, ts),
+        _quantity_observation(_RESPIRATORY_RATE, synthetic_patient_ref, ts),
+    ]
     # Blood pressure panel
-    sys_bp = _random_range(120, 12, 70, 240)
-    dia_bp = _random_range(78, 8, 40, 140)
-    obs.append({
-        "resourceType":"Observation",
-        "id": str(uuid.uuid4()),
-        "status":"final",
-        "category":[{"coding":[{"system":"http://terminology.hl7.org/CodeSystem/observation-category","code":"vital-signs"}]}],
-        "code":{"coding":[{"system":"http://loinc.org","code":"85354-9","display":"Blood pressure panel"}],"text":"Blood pressure"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "component":[
-            {"code":{"coding":[{"system":"http://loinc.org","code":"8480-6","display":"Systolic blood pressure"}],"text":"Systolic BP"},
-             "valueQuantity":{"value": sys_bp, "unit":"mmHg","system":"http://unitsofmeasure.org","code":"mm[Hg]"}},
-            {"code":{"coding":[{"system":"http://loinc.org","code":"8462-4","display":"Diastolic blood pressure"}],"text":"Diastolic BP"},
-             "valueQuantity":{"value": dia_bp, "unit":"mmHg","system":"http://unitsofmeasure.org","code":"mm[Hg]"}}
-        ]
-    })
-    # Temperature
-    temp = _random_range(36.6, 0.4, 34.0, 42.0)
-    obs.append({
-        "resourceType":"Observation",
-        "id": str(uuid.uuid4()),
-        "status":"final",
-        "category":[{"coding":[{"system":"http://terminology.hl7.org/CodeSystem/observation-category","code":"vital-signs"}]}],
-        "code":{"coding":[{"system":"http://loinc.org","code":"8310-5","display":"Body temperature"}],"text":"Body temperature"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": temp, "unit":"Cel","system":"http://unitsofmeasure.org","code":"Cel"}
-    })
-    # SpO2
-    spo2 = _random_range(98, 1.5, 80, 100)
-    obs.append({
-        "resourceType":"Observation",
-        "id": str(uuid.uuid4()),
-        "status":"final",
-        "category":[{"coding":[{"system":"http://terminology.hl7.org/CodeSystem/observation-category","code":"vital-signs"}]}],
-        "code":{"coding":[{"system":"http://loinc.org","code":"2708-6","display":"Oxygen saturation in Arterial blood by Pulse oximetry"}],"text":"SpO2"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": spo2, "unit":"%","system":"http://unitsofmeasure.org","code":"%"}
-    })
+    bp = _new_observation(_BLOOD_PRESSURE_PANEL, synthetic_patient_ref, ts)
+    bp["component"] = [
+        {"code": code, "valueQuantity": {"value": _random_range(*value_range), **quantity}}
+        for code, quantity, value_range in _BLOOD_PRESSURE_COMPONENTS
+    ]
+    obs.append(bp)
+    obs.append(_quantity_observation(_BODY_TEMPERATURE, synthetic_patient_ref, ts))
+    obs.append(_quantity_observation(_OXYGEN_SATURATION, synthetic_patient_ref, ts))
     if encounter_ref:
         for o in obs:
             o["encounter"] = {"reference": encounter_ref}
@@ -197,136 +291,117 @@ def generate_vitals_observations(synthetic_patient_ref, encounter_ref=None, time
 
 def generate_basic_lab_observations(synthetic_patient_ref, timestamp=None):
     ts = timestamp or datetime.utcnow().isoformat() + "Z"
-    labs = []
-    # Hemoglobin g/dL
-    hgb = _random_range(13.5, 1.2, 6, 20)
-    labs.append({
-        "resourceType":"Observation","id":str(uuid.uuid4()),"status":"final",
-        "code":{"coding":[{"system":"http://loinc.org","code":"718-7","display":"Hemoglobin [Mass/volume] in Blood"}],"text":"Hemoglobin"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": hgb, "unit":"g/dL","system":"http://unitsofmeasure.org","code":"g/dL"}
-    })
-    # WBC x10^9/L
-    wbc = _random_range(7.0, 2.5, 1.0, 30.0)
-    labs.append({
-        "resourceType":"Observation","id":str(uuid.uuid4()),"status":"final",
-        "code":{"coding":[{"system":"http://loinc.org","code":"6690-2","display":"Leukocytes [#/volume] in Blood by Automated count"}],"text":"WBC"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": wbc, "unit":"10^9/L","system":"http://unitsofmeasure.org","code":"10*9/L"}
-    })
-    # Platelets x10^9/L
-    plt = _random_range(250, 60, 50, 700)
-    labs.append({
-        "resourceType":"Observation","id":str(uuid.uuid4()),"status":"final",
-        "code":{"coding":[{"system":"http://loinc.org","code":"777-3","display":"Platelets [#/volume] in Blood by Automated count"}],"text":"Platelets"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": plt, "unit":"10^9/L","system":"http://unitsofmeasure.org","code":"10*9/L"}
-    })
-    # Sodium mmol/L
-    na = _random_range(140, 3, 120, 160)
-    labs.append({
-        "resourceType":"Observation","id":str(uuid.uuid4()),"status":"final",
-        "code":{"coding":[{"system":"http://loinc.org","code":"2951-2","display":"Sodium [Moles/volume] in Serum or Plasma"}],"text":"Sodium"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": na, "unit":"mmol/L","system":"http://unitsofmeasure.org","code":"mmol/L"}
-    })
-    # Potassium mmol/L
-    k = _random_range(4.1, 0.4, 2.5, 7.0)
-    labs.append({
-        "resourceType":"Observation","id":str(uuid.uuid4()),"status":"final",
-        "code":{"coding":[{"system":"http://loinc.org","code":"2823-3","display":"Potassium [Moles/volume] in Serum or Plasma"}],"text":"Potassium"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": k, "unit":"mmol/L","system":"http://unitsofmeasure.org","code":"mmol/L"}
-    })
-    # Creatinine mg/dL
-    cr = _random_range(0.95, 0.25, 0.2, 10.0)
-    labs.append({
-        "resourceType":"Observation","id":str(uuid.uuid4()),"status":"final",
-        "code":{"coding":[{"system":"http://loinc.org","code":"2160-0","display":"Creatinine [Mass/volume] in Serum or Plasma"}],"text":"Creatinine"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": cr, "unit":"mg/dL","system":"http://unitsofmeasure.org","code":"mg/dL"}
-    })
-    # Glucose mg/dL
-    glu = _random_range(98, 20, 40, 400)
-    labs.append({
-        "resourceType":"Observation","id":str(uuid.uuid4()),"status":"final",
-        "code":{"coding":[{"system":"http://loinc.org","code":"2345-7","display":"Glucose [Mass/volume] in Blood"}],"text":"Glucose"},
-        "subject":{"reference": synthetic_patient_ref},
-        "effectiveDateTime": ts,
-        "valueQuantity":{"value": glu, "unit":"mg/dL","system":"http://unitsofmeasure.org","code":"mg/dL"}
-    })
-    return labs
+    return [_quantity_observation(template, synthetic_patient_ref, ts) for template in _BASIC_LABS]
 
 
 # -------------------------
 # Core bundle construction
 # -------------------------
-def find_reference_strings(obj):
+def find_reference_strings(obj, skip_patient_refs=False):
+    # one C-level regex pass over the serialized resource instead of walking every
+    # string; the type is the run of letters right before the matched "/id"
     refs = set()
-    def _walk(o):
-        if isinstance(o, dict):
-            if "reference" in o and isinstance(o["reference"], str):
-                m = REF_RE.search(o["reference"])
-                if m:
-                    refs.add((m.group(1), m.group(2)))
-            for k, v in o.items():
-                if isinstance(v, str):
-                    m = REF_RE.search(v)
-                    if m:
-                        refs.add((m.group(1), m.group(2)))
-                else:
-                    _walk(v)
-        elif isinstance(o, list):
-            for item in o:
-                _walk(item)
-    _walk(obj)
+    data = _dumps(obj)
+    for m in REF_ID_RE_BYTES.finditer(data):
+        end = i = m.start()
+        while i and data[i - 1] in _TYPE_BYTES:
+            i -= 1
+        if i == end:
+            continue
+        # an unescaped quote before the type means the string starts with the reference
+        if skip_patient_refs and data[i:end] == b"Patient" and data[i - 1] == 0x22 and data[i - 2] != 0x5C:
+            continue
+        refs.add(data[i:m.end() - 1].decode())
     return refs
 
-def _normalize_patient_refs_in_resource(obj, synthetic_patient_ref):
-    if isinstance(obj, dict):
-        for k, v in list(obj.items()):
-            if k == "reference" and isinstance(v, str) and v.startswith("Patient/"):
-                obj[k] = synthetic_patient_ref
-            elif isinstance(v, str) and v.startswith("Patient/"):
-                obj[k] = synthetic_patient_ref
+# (key, skip_patient_refs) -> (resource, frozenset of refs); library resources are
+# never mutated after load, so an entry stays valid while it points at the same object
+_refs_cache = {}
+
+def _cached_reference_strings(key, res, skip_patient_refs):
+    cache_key = (key, skip_patient_refs)
+    hit = _refs_cache.get(cache_key)
+    if hit is not None and hit[0] is res:
+        return hit[1]
+    refs = frozenset(find_reference_strings(res, skip_patient_refs=skip_patient_refs))
+    _refs_cache[cache_key] = (res, refs)
+    return refs
+
+def _clone_with_patient_refs(obj, synthetic_patient_ref=None):
+    # deep copy that points every Patient/* string value at the synthetic patient, in one
+    # walk; library resources are plain JSON trees, so deepcopy's memo bookkeeping buys nothing.
+    # Parsed JSON only holds exact dict/list/str types, so `type() is` stands in for isinstance.
+    t = type(obj)
+    if t is dict:
+        out = {}
+        for k, v in obj.items():
+            vt = type(v)
+            if vt is str:
+                out[k] = synthetic_patient_ref if synthetic_patient_ref and v.startswith("Patient/") else v
+            elif vt is dict or vt is list:
+                out[k] = _clone_with_patient_refs(v, synthetic_patient_ref)
             else:
-                _normalize_patient_refs_in_resource(v, synthetic_patient_ref)
-    elif isinstance(obj, list):
-        for item in obj:
-            _normalize_patient_refs_in_resource(item, synthetic_patient_ref)
+                out[k] = v
+        return out
+    if t is list:
+        return [_clone_with_patient_refs(item, synthetic_patient_ref) for item in obj]
+    return obj
 
 def include_resource_and_children(bundle, resources_by_key, key, bundle_fullUrls, synthetic_patient_ref=None):
-    if key not in resources_by_key:
-        return
-    res = resources_by_key[key]
-    fullUrl = f"{res['resourceType']}/{res['id']}"
-    if fullUrl in bundle_fullUrls:
-        return
-    import copy
-    res_copy = copy.deepcopy(res)
-    if synthetic_patient_ref:
-        _normalize_patient_refs_in_resource(res_copy, synthetic_patient_ref)
-    bundle["entry"].append({"fullUrl": fullUrl, "resource": res_copy})
-    bundle_fullUrls.add(fullUrl)
-    refs = find_reference_strings(res_copy)
-    for rtype, rid in refs:
-        child_key = (rtype, rid)
-        if child_key in resources_by_key:
-            include_resource_and_children(bundle, resources_by_key, child_key, bundle_fullUrls, synthetic_patient_ref)
-
-
-def build_composition_and_bundle(resources_by_key, index_by_type, compositions_list, use_synthetic=True, randomize_values=False):
+    # explicit worklist instead of recursion: no frame per child, no recursion limit
+    todo = [key]
+    while todo:
+        key = todo.pop()
+        if key not in resources_by_key:
+            continue
+        if key in bundle_fullUrls:
+            continue
+        res = resources_by_key[key]
+        res_copy = _clone_with_patient_refs(res, synthetic_patient_ref)
+        bundle["entry"].append({"fullUrl": key, "resource": res_copy})
+        bundle_fullUrls.add(key)
+        # Patient refs were rewritten to the synthetic patient above, so don't follow them
+        refs = _cached_reference_strings(key, res, bool(synthetic_patient_ref))
+        for child_key in refs:
+            if child_key in resources_by_key and child_key not in bundle_fullUrls:
+                todo.append(child_key)
+
+
+# id(template) -> (template, [(title, [key or None per entry]), ...]); templates are
+# never mutated, so each one's section references are parsed only once
+_template_sections_cache = {}
+
+def _template_sections(template):
+    hit = _template_sections_cache.get(id(template))
+    if hit is not None and hit[0] is template:
+        return hit[1]
+    sections = []
+    for sec in template.get("section", []):
+        # keep a None slot for unusable entries so sampling sees the same population
+        keys = []
+        for e in sec.get("entry", []):
+            key = None
+            if isinstance(e, dict) and isinstance(e.get("reference"), str):
+                m = REF_RE.search(e["reference"])
+                if m:
+                    key = f"{m.group(1)}/{m.group(2)}"
+            keys.append(key)
+        sections.append((sec.get("title", "Section"), keys))
+    _template_sections_cache[id(template)] = (template, sections)
+    return sections
+
+
+def build_composition_and_bundle(resources_by_key, index_by_type, compositions_list, use_synthetic=True, randomize_values=False, pretty=False, write=True):
     """
     Returns: (composition, bundle, output_file)
     - By default uses synthetic patient (use_synthetic param kept for backwards compatibility)
     - randomize_values=True adds vitals & basic labs as Observations associated with the synthetic patient
+    - pretty=True writes indented JSON instead of compact output
+    - write=False skips writing; output_file is still returned for the caller to save
     """
+    now = datetime.utcnow()
+    now_iso = now.isoformat() + "Z"
+
     # pick a composition template if present
     composition_template = random.choice(compositions_list) if compositions_list else None
 
@@ -334,7 +409,7 @@ def build_composition_and_bundle(resources_by_key, index_by_type, compositions_l
     synthetic_patient_ref = f"Patient/{synthetic_patient['id']}"
 
     # Build composition
-    comp_id = f"generated-comp-{uuid.uuid4()}"
+    comp_id = f"generated-comp-{_new_id()}"
     composition = {
         "resourceType": "Composition",
         "id": comp_id,
@@ -346,8 +421,8 @@ def build_composition_and_bundle(resources_by_key, index_by_type, compositions_l
                 "display": "Clinical Document"
             }]
         },
-        "title": f"Synthetic Composition Document ({datetime.utcnow().isoformat()}Z)",
-        "date": datetime.utcnow().isoformat() + "Z",
+        "title": f"Synthetic Composition Document ({now_iso})",
+        "date": now_iso,
         "author": [{"display": "SyntheticGenerator"}],
         "subject": {"reference": synthetic_patient_ref},
         "section": []
@@ -358,52 +433,56 @@ def build_composition_and_bundle(resources_by_key, index_by_type, compositions_l
     composition_sections = []
 
     if composition_template and "section" in composition_template:
-        template_sections = composition_template.get("section", [])
+        template_sections = _template_sections(composition_template)
 
         # Pick N sections
         n_sections = random.randint(MIN_SECTIONS, MAX_SECTIONS)
-        selected_sections = random.sample(
-            template_sections,
-            min(len(template_sections), n_sections)
-        )
+        # taking every section (common: templates are often smaller than MAX_SECTIONS)
+        # needs no sample/copy; the template order is kept
+        if n_sections >= len(template_sections):
+            selected_sections = template_sections
+        else:
+            selected_sections = random.sample(template_sections, n_sections)
 
-        for sec in selected_sections:
+        for title, template_keys in selected_sections:
             entries = []
 
             # pick entries
-            template_entries = sec.get("entry", [])
             n_entries = random.randint(MIN_ENTRIES_PER_SECTION, MAX_ENTRIES_PER_SECTION)
-            selected_entries = random.sample(
-                template_entries,
-                min(len(template_entries), n_entries)
-            )
-
-            for e in selected_entries:
-                if isinstance(e, dict) and "reference" in e:
-                    ref = e["reference"]
-                    m = REF_RE.search(ref)
-                    if m:
-                        rtype, rid = m.group(1), m.group(2)
-                        key = (rtype, rid)
-                        entries.append({"reference": f"{rtype}/{rid}"})
-                        selected_keys.add(key)
+            if n_entries >= len(template_keys):
+                selected_entries = template_keys
+            else:
+                selected_entries = random.sample(template_keys, n_entries)
+
+            for key in selected_entries:
+                if key is None:
+                    continue
+                if key.startswith("Patient/"):
+                    # the bundle has a single patient; point at it rather than including another
+                    entries.append({"reference": synthetic_patient_ref})
+                else:
+                    entries.append({"reference": key})
+                    selected_keys.add(key)
 
             if entries:
                 composition_sections.append({
-                    "title": sec.get("title", "Section"),
+                    "title": title,
                     "entry": entries
                 })
 
     else:
         # fallback if template doesn't have sections
+        episode_ref = f"Encounter/{_new_id()}"
+        observation_ref = f"Observation/{_new_id()}"
         composition_sections.append({
             "title": "Synthetic Episode",
-            "entry": [{"reference": f"Encounter/{str(uuid.uuid4())}"}]
+            "entry": [{"reference": episode_ref}]
         })
         composition_sections.append({
             "title": "Synthetic Observations",
-            "entry": [{"reference": f"Observation/{str(uuid.uuid4())}"}]
+            "entry": [{"reference": observation_ref}]
         })
+        selected_keys.update((episode_ref, observation_ref))
 
     composition["section"] = composition_sections
 
@@ -411,7 +490,7 @@ def build_composition_and_bundle(resources_by_key, index_by_type, compositions_l
     bundle = {
         "resourceType": "Bundle",
         "type": "document",
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": now_iso,
         "entry": [
             {"fullUrl": f"Composition/{composition['id']}", "resource": composition},
             {"fullUrl": synthetic_patient_ref, "resource": synthetic_patient}
@@ -419,17 +498,18 @@ def build_composition_and_bundle(resources_by_key, index_by_type, compositions_l
     }
     bundle_fullUrls = set([f"Composition/{composition['id']}", synthetic_patient_ref])
 
-    # include referenced resources from library or placeholders
+    # include referenced resources from library or placeholders; selected_keys holds every
+    # section reference, so each one is present in the bundle after this loop
     for key in list(selected_keys):
         if key in resources_by_key:
             include_resource_and_children(bundle, resources_by_key, key, bundle_fullUrls, synthetic_patient_ref)
         else:
-            rtype, rid = key
+            rtype, rid = key.split("/", 1)
             placeholder = {"resourceType": rtype, "id": rid}
             if rtype in ("Observation", "Procedure", "Encounter", "Specimen", "ServiceRequest", "ImagingStudy", "DiagnosticReport"):
                 placeholder["subject"] = {"reference": synthetic_patient_ref}
-            bundle["entry"].append({"fullUrl": f"{rtype}/{rid}", "resource": placeholder})
-            bundle_fullUrls.add(f"{rtype}/{rid}")
+            bundle["entry"].append({"fullUrl": key, "resource": placeholder})
+            bundle_fullUrls.add(key)
 
     # Optionally generate vitals & labs
     if randomize_values:
@@ -440,48 +520,25 @@ def build_composition_and_bundle(resources_by_key, index_by_type, compositions_l
             if r.get("resourceType") == "Encounter":
                 encounter_ref = f"Encounter/{r.get('id')}"
                 break
-        vitals = generate_vitals_observations(synthetic_patient_ref, encounter_ref=encounter_ref)
+        vitals = generate_vitals_observations(synthetic_patient_ref, encounter_ref=encounter_ref, timestamp=now_iso)
         for v in vitals:
             full = f"Observation/{v['id']}"
             if full not in bundle_fullUrls:
                 bundle['entry'].append({'fullUrl': full, 'resource': v})
                 bundle_fullUrls.add(full)
 
-        labs = generate_basic_lab_observations(synthetic_patient_ref)
+        labs = generate_basic_lab_observations(synthetic_patient_ref, timestamp=now_iso)
         for l in labs:
             full = f"Observation/{l['id']}"
             if full not in bundle_fullUrls:
                 bundle['entry'].append({'fullUrl': full, 'resource': l})
                 bundle_fullUrls.add(full)
 
-    # Normalize any Patient refs inside the bundle to the synthetic patient
-    _normalize_patient_refs_in_resource(bundle, synthetic_patient_ref)
-
-    # Ensure references in composition sections are present (create placeholders if needed)
-    for sec in composition["section"]:
-        for e in sec.get("entry", []):
-            m = REF_RE.search(e["reference"])
-            if m:
-                fullUrl = f"{m.group(1)}/{m.group(2)}"
-                if fullUrl not in bundle_fullUrls:
-                    key = (m.group(1), m.group(2))
-                    if key in resources_by_key:
-                        include_resource_and_children(bundle, resources_by_key, key, bundle_fullUrls, synthetic_patient_ref)
-                    else:
-                        placeholder = {"resourceType": m.group(1), "id": m.group(2)}
-                        if m.group(1) in ("Observation","Procedure","Encounter","Specimen","ServiceRequest","ImagingStudy","DiagnosticReport"):
-                            placeholder["subject"] = {"reference": synthetic_patient_ref}
-                        bundle["entry"].append({"fullUrl": fullUrl, "resource": placeholder})
-                        bundle_fullUrls.add(fullUrl)
-
-    # final normalization pass (defensive)
-    _normalize_patient_refs_in_resource(bundle, synthetic_patient_ref)
-
     # write to file
-    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-    out_file = get_output_filename()
-    with open(out_file, "w", encoding="utf-8") as fh:
-        json.dump(bundle, fh, indent=2, ensure_ascii=False)
+    out_file = get_output_filename(now)
+    if write:
+        os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+        write_json_file(bundle, out_file, pretty=pretty)
 
     return composition, bundle, out_file
 
@@ -493,16 +550,17 @@ def normalize_patient_refs_in_bundle(bundle, mapping=None, canonical=None):
     if mapping is None and canonical is None:
         return bundle
     def _walk(o):
-        if isinstance(o, dict):
+        t = type(o)
+        if t is dict:
             for k,v in list(o.items()):
-                if k == "reference" and isinstance(v, str) and v.startswith("Patient/"):
+                if k == "reference" and type(v) is str and v.startswith("Patient/"):
                     if mapping and v in mapping:
                         o[k] = mapping[v]
                     elif canonical:
                         o[k] = canonical
                 else:
                     _walk(v)
-        elif isinstance(o, list):
+        elif t is list:
             for item in o:
                 _walk(item)
     _walk(bundle)
@@ -511,8 +569,26 @@ def normalize_patient_refs_in_bundle(bundle, mapping=None, canonical=None):
 def structural_validate_bundle(bundle):
     issues = []
     present = set()
-    entries = bundle.get("entry", [])
-    for e in entries:
+    comp = None
+    # (reference, resource) for every Patient ref, in document order; checked once present is complete
+    patient_refs = []
+
+    def _walk(o, res):
+        if type(o) is dict:
+            for k, v in o.items():
+                t = type(v)
+                if t is str:
+                    if k == "reference" and v.startswith("Patient/"):
+                        patient_refs.append((v, res))
+                elif t is dict or t is list:
+                    _walk(v, res)
+        else:
+            for it in o:
+                t = type(it)
+                if t is dict or t is list:
+                    _walk(it, res)
+
+    for e in bundle.get("entry", []):
         full = e.get("fullUrl")
         res = e.get("resource")
         if full:
@@ -522,11 +598,11 @@ def structural_validate_bundle(bundle):
         else:
             issues.append({"severity":"error","detail":"entry with no fullUrl and no resource id"})
 
-    comp = None
-    for e in entries:
-        if e.get("resource",{}).get("resourceType") == "Composition":
-            comp = e["resource"]
-            break
+        if not isinstance(res, dict):
+            continue
+        if comp is None and res.get("resourceType") == "Composition":
+            comp = res
+        _walk(res, res)
 
     if not comp:
         issues.append({"severity":"error","detail":"No Composition in Bundle"})
@@ -550,24 +626,61 @@ def structural_validate_bundle(bundle):
                     issues.append({"severity":"error","detail":f"Reference {ref} in composition.section not present in bundle"})
 
     # check patient refs inside resources point to present patient
-    for e in entries:
-        res = e.get("resource")
-        if isinstance(res, dict):
-            def _walk(o):
-                if isinstance(o, dict):
-                    for k,v in o.items():
-                        if k == "reference" and isinstance(v, str) and v.startswith("Patient/"):
-                            if v not in present:
-                                issues.append({"severity":"error","detail":f"Patient reference {v} in resource {res.get('resourceType')}/{res.get('id')} not present in bundle"})
-                        else:
-                            _walk(v)
-                elif isinstance(o, list):
-                    for it in o:
-                        _walk(it)
-            _walk(res)
+    for v, res in patient_refs:
+        if v not in present:
+            issues.append({"severity":"error","detail":f"Patient reference {v} in resource {res.get('resourceType')}/{res.get('id')} not present in bundle"})
     return issues
 
 
+# -------------------------
+# Batch generation
+# -------------------------
+_worker_library = None
+
+def _init_generate_worker(folder, prefix):
+    # each worker process parses the library once and reuses it for all of its bundles
+    global _worker_library
+    _worker_library = load_library(folder, prefix)
+
+def _generate_one(task):
+    index, options = task
+    resources_by_key, index_by_type, compositions_list = _worker_library
+    composition, bundle, _ = build_composition_and_bundle(
+        resources_by_key, index_by_type, compositions_list,
+        use_synthetic=options["use_synthetic"],
+        randomize_values=options["randomize_values"],
+        write=False
+    )
+    if options["mapping"]:
+        normalize_patient_refs_in_bundle(bundle, mapping=options["mapping"])
+    if options["canonical"]:
+        normalize_patient_refs_in_bundle(bundle, canonical=options["canonical"])
+    issues = structural_validate_bundle(bundle)
+    # bundles built in the same second would share a timestamped name; add the task index
+    out_file = get_output_filename(suffix=f"{index:05d}")
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    write_json_file(bundle, out_file, pretty=options["pretty"])
+    return composition["id"], out_file, issues
+
+def generate_many(count, folder=LIB_FOLDER, prefix=INPUT_PREFIX, workers=None, use_synthetic=True,
+                  randomize_values=False, pretty=False, mapping=None, canonical=None):
+    """
+    Generates `count` bundles in parallel worker processes and writes each to its own file.
+    Returns a list of (composition_id, output_file, issues) in task order.
+    """
+    options = {
+        "use_synthetic": use_synthetic,
+        "randomize_values": randomize_values,
+        "pretty": pretty,
+        "mapping": mapping,
+        "canonical": canonical,
+    }
+    workers = min(workers or os.cpu_count() or 1, max(count, 1))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_generate_worker,
+                             initargs=(folder, prefix)) as ex:
+        return list(ex.map(_generate_one, [(i, options) for i in range(count)]))
+
+
 # Script entrypoint
 if __name__ == "__main__":
     import argparse
@@ -576,10 +689,11 @@ if __name__ == "__main__":
     parser.add_argument("--output", required=False, default=None)
     parser.add_argument("--randomize-values", action="store_true", default=False,
                         help="If set, generate vitals & lab observations for synthetic patient.")
+    parser.add_argument("--pretty", action="store_true", default=False,
+                        help="If set, write indented JSON instead of compact output.")
     args = parser.parse_args()
 
-    with open(args.input, "r", encoding="utf-8") as fh:
-        b = json.load(fh)
+    b = read_json_file(args.input)
 
     resources_by_key = {}
     index_by_type = {}
@@ -589,18 +703,10 @@ if __name__ == "__main__":
         res = entry.get("resource")
         if not res or "resourceType" not in res:
             continue
-        rtype = res["resourceType"]
-        rid = res.get("id") or str(uuid.uuid4())
-        res["id"] = rid
-        key = (rtype, rid)
-        resources_by_key[key] = res
-        index_by_type.setdefault(rtype, []).append(key)
-        if rtype == "Composition":
-            compositions_list.append(res)
-
-    comp, new_bundle, out_file = build_composition_and_bundle(resources_by_key, index_by_type, compositions_list, use_synthetic=True, randomize_values=args.randomize_values)
+        _index_resource(res, resources_by_key, index_by_type, compositions_list)
+
+    comp, new_bundle, out_file = build_composition_and_bundle(resources_by_key, index_by_type, compositions_list, use_synthetic=True, randomize_values=args.randomize_values, pretty=args.pretty, write=args.output is None)
     if args.output:
         out_file = args.output
-        with open(out_file, "w", encoding="utf-8") as fh:
-            json.dump(new_bundle, fh, indent=2, ensure_ascii=False)
+        write_json_file(new_bundle, out_file, pretty=args.pretty)
     print("Wrote:", out_file)